@@ -1,8 +1,21 @@
-from flask import Flask, render_template, url_for, redirect, request, flash, send_from_directory
+from flask import Flask, render_template, url_for, redirect, request, flash, send_from_directory, make_response, session, g
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from jinja2 import FileSystemBytecodeCache
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required, UserMixin
+from sqlalchemy import tuple_, text, event, or_, func, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload, raiseload
 from datetime import datetime
+from collections import Counter
 import os
+import atexit
+import hashlib
+import click
+import sqlite3
+import tempfile
+import threading
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
@@ -12,14 +25,73 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-i
 basedir = os.path.abspath(os.path.dirname(__file__))
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'forum.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 5, 'pool_pre_ping': True}
 
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  #max 16 mb
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'doc', 'docx'}
+ALLOWED_EXTENSIONS = frozenset({'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip', 'doc', 'docx'})
+ALLOWED_EXT_WITH_DOT = frozenset('.' + ext for ext in ALLOWED_EXTENSIONS)  # в формате os.path.splitext
+# Явная стоимость хеша, чтобы обновление Werkzeug не меняло время логина; влезает в password_hash(120)
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Шаблоны не перечитываются с диска на каждый запрос, а скомпилированный байткод
+# переживает перезапуск воркера. Каталог по умолчанию - свой на каждого uid и с правами 0700,
+# чтобы другой пользователь не мог подложить .cache файлы
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Профилирование только по флагу окружения: постоянный профайлер замедляет каждый запрос.
+# PROFILE=1 - cProfile всех запросов в profiler_results/,
+# PROFILE=pyinstrument - отчет pyinstrument вместо страницы для запросов с ?profile=1
+if os.environ.get('PROFILE') == '1':
+    from werkzeug.middleware.profiler import ProfilerMiddleware
+    profile_dir = os.path.join(basedir, 'profiler_results')
+    os.makedirs(profile_dir, exist_ok=True)
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profile_dir=profile_dir, restrictions=[30], stream=None)
+
+elif os.environ.get('PROFILE') == 'pyinstrument':
+    from pyinstrument import Profiler
+
+    @app.before_request
+    def start_request_profiler():
+        if request.args.get('profile') == '1':
+            g.profiler = Profiler(interval=0.001, async_mode='disabled')
+            g.profiler.start()
+
+    @app.after_request
+    def stop_request_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.stop()
+        return make_response(profiler.output_html())
+
+# SimpleCache живет в памяти процесса; при наличии REDIS_URL кеш общий для всех воркеров
+app.config['CACHE_TYPE'] = 'RedisCache' if os.environ.get('REDIS_URL') else 'SimpleCache'
+app.config['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL')
+app.config['CACHE_DEFAULT_TIMEOUT'] = 60
+LATEST_TOPICS_CACHE_KEY = 'index_latest_topics'
+VIEWS_FLUSH_INTERVAL = 30  # секунды между сбросами счетчика просмотров в БД
+USER_CACHE_TIMEOUT = 30
+
 db = SQLAlchemy(app)
+cache = Cache(app)
+
+# WAL: читатели не блокируют запись, а commit не делает fsync всей базы
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragma(dbapi_conn, _):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA busy_timeout=5000')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.close()
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Пожалуйста, войдите для доступа к этой странице.'
@@ -33,11 +105,18 @@ class User(UserMixin, db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_admin = db.Column(db.Boolean, default=False)
     is_active = db.Column(db.Boolean, default=True)  # Мягкое удаление
-    topics = db.relationship('Topic', backref='author', lazy=True)
+    topics = db.relationship('Topic', backref='author', lazy=True, foreign_keys='Topic.user_id')
     replies = db.relationship('Reply', backref='author', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_user_active', is_active),
+        db.Index('ix_user_created_id', created_at.desc(), id.desc()),
+    )
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+        if self.id is not None:
+            forget_user(self.id)
     
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -50,16 +129,18 @@ class Topic(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     views = db.Column(db.Integer, default=0)
     is_deleted = db.Column(db.Boolean, default=False)  # Мягкое удаление
+    reply_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)  # Денормализованный счетчик ответов
+    last_reply_at = db.Column(db.DateTime, index=True)  # Время и автор последнего ответа (денормализовано)
+    last_reply_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    last_reply_user = db.relationship('User', foreign_keys=[last_reply_user_id])
     replies = db.relationship('Reply', backref='topic', lazy=True, cascade='all, delete-orphan')
     attachments = db.relationship('Attachment', backref='topic', lazy=True, cascade='all, delete-orphan')
-    
-    @property
-    def reply_count(self):
-        return len(self.replies)
-    
-    @property
-    def last_reply(self):
-        return Reply.query.filter_by(topic_id=self.id).order_by(Reply.created_at.desc()).first()
+
+    # Индексы под keyset-пагинацию в /forum и ленту на главной
+    __table_args__ = (
+        db.Index('ix_topic_created_id', created_at.desc(), id.desc()),
+        db.Index('ix_topic_active_created', is_deleted, created_at.desc(), id.desc()),
+    )
 
 class Reply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -69,6 +150,10 @@ class Reply(db.Model):
     topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), nullable=False)
     attachments = db.relationship('Attachment', backref='reply', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_reply_topic_created', topic_id, created_at.desc()),
+    )
+
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
@@ -79,38 +164,273 @@ class Attachment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
 def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return os.path.splitext(filename)[1].lower() in ALLOWED_EXT_WITH_DOT
+
+def save_upload(file):
+    # Имя файла - хеш содержимого: повторная загрузка того же файла не занимает место
+    ext = os.path.splitext(file.filename)[1].lower()
+    h = hashlib.blake2b(digest_size=16)
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while chunk := file.stream.read(1 << 20):
+                h.update(chunk)
+                tmp.write(chunk)
+
+        stored_filename = h.hexdigest() + ext
+        stored_path = os.path.join(app.config['UPLOAD_FOLDER'], stored_filename)
+        if os.path.exists(stored_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, stored_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return stored_filename
+
+def build_attachments(files, **owner):
+    # owner - topic_id или reply_id; вставляются одним add_all
+    return [
+        Attachment(
+            filename=save_upload(file),
+            original_filename=secure_filename(file.filename),
+            user_id=current_user.id,
+            **owner
+        )
+        for file in files
+        if file and file.filename and allowed_file(file.filename)
+    ]
+
+def keyset_page(query, model, per_page, endpoint):
+    # keyset-пагинация: страница начинается после (created_at, id) последней записи
+    after_created_at = request.args.get('after_created_at', type=datetime.fromisoformat)
+    after_id = request.args.get('after_id', type=int)
+
+    if after_created_at is not None and after_id is not None:
+        query = query.filter(tuple_(model.created_at, model.id) < (after_created_at, after_id))
+
+    items = query.order_by(model.created_at.desc(), model.id.desc())\
+        .limit(per_page + 1).all()
+
+    next_url = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_url = url_for(endpoint, after_created_at=last.created_at.isoformat(), after_id=last.id)
+    return items, next_url
+
+@app.template_filter('dt')
+def format_datetime(value, fmt='%d.%m.%Y %H:%M'):
+    # Даты хранятся как datetime и форматируются только при выводе
+    return value.strftime(fmt) if value else ''
 
 def is_admin():
     return current_user.is_authenticated and current_user.is_admin
 
+def upgrade_schema():
+    # db.create_all() не добавляет колонки в уже существующие таблицы - докидываем их сами
+    columns = {column['name'] for column in inspect(db.engine).get_columns('topic')}
+    if 'reply_count' not in columns:
+        db.session.execute(text('ALTER TABLE topic ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0'))
+    if 'last_reply_at' not in columns:
+        db.session.execute(text('ALTER TABLE topic ADD COLUMN last_reply_at DATETIME'))
+    if 'last_reply_user_id' not in columns:
+        db.session.execute(text('ALTER TABLE topic ADD COLUMN last_reply_user_id INTEGER REFERENCES "user" (id)'))
+    db.session.commit()
+
+    # Индексы из моделей, которых еще нет в базе (в том числе ix_topic_last_reply_at)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def latest_replies():
+    # Последний ответ каждой темы одним запросом через ROW_NUMBER() вместо запроса на тему
+    rn = db.func.row_number().over(
+        partition_by=Reply.topic_id,
+        order_by=(Reply.created_at.desc(), Reply.id.desc())
+    ).label('rn')
+    ranked = db.select(Reply.topic_id, Reply.user_id, Reply.created_at, rn).subquery()
+    rows = db.session.execute(db.select(ranked).where(ranked.c.rn == 1))
+    return {row.topic_id: row for row in rows}
+
+def sync_topic_stats():
+    # Пересчет reply_count и last_reply_* по таблице reply (разовая миграция / починка счетчиков)
+    db.session.execute(text(
+        'UPDATE topic SET '
+        'reply_count = (SELECT count(*) FROM reply WHERE reply.topic_id = topic.id), '
+        'last_reply_at = NULL, last_reply_user_id = NULL'
+    ))
+    last = latest_replies()
+    if last:
+        db.session.execute(db.update(Topic), [
+            {'id': topic_id, 'last_reply_at': row.created_at, 'last_reply_user_id': row.user_id}
+            for topic_id, row in last.items()
+        ])
+    db.session.commit()
+
+
+# Просмотры копятся вне БД и сбрасываются пачкой, чтобы GET темы не делал COMMIT.
+# С REDIS_URL счетчик общий для всех воркеров, иначе Counter в памяти процесса.
+if os.environ.get('REDIS_URL'):
+    import redis
+    views_redis = redis.Redis.from_url(os.environ['REDIS_URL'])
+else:
+    views_redis = None
+pending_views = Counter()
+pending_views_lock = threading.Lock()
+
+def count_view(topic_id):
+    if views_redis is not None:
+        views_redis.hincrby('topic_views', topic_id, 1)
+        return
+    with pending_views_lock:
+        pending_views[topic_id] += 1
+
+def flush_views():
+    if views_redis is not None:
+        pipe = views_redis.pipeline()
+        pipe.hgetall('topic_views')
+        pipe.delete('topic_views')
+        batch, _ = pipe.execute()
+        batch = {int(topic_id): int(n) for topic_id, n in batch.items()}
+    else:
+        with pending_views_lock:
+            batch = dict(pending_views)
+            pending_views.clear()
+
+    if not batch:
+        return
+    try:
+        db.session.execute(
+            text('UPDATE topic SET views = views + :n WHERE id = :topic_id'),
+            [{'topic_id': topic_id, 'n': n} for topic_id, n in batch.items()]
+        )
+        db.session.commit()
+    except Exception:
+        # Возвращаем пачку обратно, чтобы просмотры ушли со следующим сбросом
+        db.session.rollback()
+        if views_redis is not None:
+            pipe = views_redis.pipeline()
+            for topic_id, n in batch.items():
+                pipe.hincrby('topic_views', topic_id, n)
+            pipe.execute()
+        else:
+            with pending_views_lock:
+                pending_views.update(batch)
+        raise
+
+
+def forget_user(user_id):
+    cache.delete(f'user:{user_id}')
 
+# Flask-Login вызывает load_user на каждый запрос: берем пользователя из кеша,
+# а merge(load=False) привязывает копию к сессии без SELECT
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    key = f'user:{int(user_id)}'
+    user = cache.get(key)
+    if user is None:
+        user = db.session.get(User, int(user_id))
+        if user is None:
+            return None
+        db.session.expunge(user)
+        cache.set(key, user, timeout=USER_CACHE_TIMEOUT)
+    return db.session.merge(user, load=False)
+
+
+# Схема создается явно (flask init-db), а не при импорте в каждом воркере
+@app.cli.command('init-db')
+@click.option('--drop', is_flag=True, help='Удалить все таблицы перед созданием.')
+@click.option('--demo', is_flag=True, help='Добавить тестового админа и темы.')
+def init_db_command(drop, demo):
+    """Создать таблицы базы данных."""
+    if drop:
+        db.drop_all()
+    db.create_all()
+    upgrade_schema()
 
+    if demo:
+        test_admin = User(username='Curaga', email='admin@dash.com', is_admin=True)
+        test_admin.set_password('1234')
+        db.session.add(test_admin)
 
-with app.app_context():
-    db.create_all()
+        topic1 = Topic(title='Добро пожаловать на форум!', 
+                      content='Это тестовая тема для демонстрации работы форума.', 
+                      author=test_admin)
+        topic2 = Topic(title='Правила форума', 
+                      content='Здесь будут правила нашего форума.', 
+                      author=test_admin)
+        db.session.add_all([topic1, topic2])
+        
+        reply1 = Reply(content='Отличный форум!', author=test_admin, topic=topic1)
+        reply2 = Reply(content='Согласен с правилами', author=test_admin, topic=topic2)
+        db.session.add_all([reply1, reply2])
+        
+        db.session.commit()
+        sync_topic_stats()
+        print("Test data created successfully!")
+
+    print('Database initialized')
+
+
+@app.cli.command('sync-counters')
+def sync_counters_command():
+    """Пересчитать счетчики и последний ответ у всех тем."""
+    upgrade_schema()
+    sync_topic_stats()
+    print('Topic counters synced')
 
 
 @app.route('/')
 def index():
-    latest_topics = Topic.query.order_by(Topic.created_at.desc()).limit(5).all()
-    return render_template('index.html', topics=latest_topics)
+    # Кешируется только фрагмент со списком тем: шапка зависит от пользователя
+    latest_topics_html = cache.get(LATEST_TOPICS_CACHE_KEY)
+    if latest_topics_html is None:
+        latest_topics = Topic.query.options(selectinload(Topic.author))\
+            .order_by(Topic.created_at.desc()).limit(5).all()
+        latest_topics_html = render_template('latest_topics.html', topics=latest_topics)
+        cache.set(LATEST_TOPICS_CACHE_KEY, latest_topics_html, timeout=60)
+
+    response = make_response(render_template('index.html', latest_topics_html=latest_topics_html))
+
+    if not current_user.is_authenticated and '_flashes' not in session:
+        response.headers['Cache-Control'] = 'public, max-age=30'
+        response.headers['Vary'] = 'Cookie'
+        response.set_etag(hashlib.blake2b(latest_topics_html.encode(), digest_size=16).hexdigest())
+        response.make_conditional(request)
+
+    return response
 
 @app.route('/forum')
 def topics():
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
+    # ETag по одному агрегату с теми же фильтрами, что и у страницы: новая тема, ответ,
+    # удаление темы, (де)активация автора или очередной сброс просмотров меняют его
+    stamp = db.session.query(func.max(Topic.id), func.max(Topic.last_reply_at), func.count(Topic.id),
+                             func.sum(Topic.views))\
+        .filter(Topic.is_deleted == False)\
+        .join(Topic.author).filter(User.is_active == True).one()
+    etag = hashlib.blake2b(f'{tuple(stamp)}:{current_user.get_id()}:{request.full_path}'.encode(), digest_size=16).hexdigest()
+
+    response = make_response()
+    if '_flashes' in session:
+        # Страница с flash-сообщением одноразовая: без валидатора, иначе 304 покажет его снова
+        response.cache_control.no_store = True
+    else:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        if request.if_none_match.contains(etag):
+            return response.make_conditional(request)
+
+    query = Topic.query.options(selectinload(Topic.author), selectinload(Topic.last_reply_user))\
+        .filter_by(is_deleted=False)\
+        .join(Topic.author).filter(User.is_active == True)
 
-    all_topics = Topic.query.filter_by(is_deleted=False)\
-        .join(User).filter(User.is_active == True)\
-        .order_by(Topic.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False)
+    page_topics, next_url = keyset_page(query, Topic, 20, 'topics')
     
-    return render_template('topics.html', topics=all_topics.items)
+    response.set_data(render_template('topics.html', topics=page_topics, next_url=next_url))
+    return response
 
 @app.route('/new_topic', methods=['GET', 'POST'])
 @login_required
@@ -125,23 +445,10 @@ def new_topic():
             db.session.flush() 
             
             if 'files' in request.files:
-                files = request.files.getlist('files')
-                for file in files:
-                    if file and file.filename and allowed_file(file.filename):
-                        filename = secure_filename(file.filename)
-                        unique_filename = f"{datetime.now().timestamp()}_{filename}"
-                        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                        file.save(file_path)
-                        
-                        attachment = Attachment(
-                            filename=unique_filename,
-                            original_filename=filename,
-                            topic_id=new_topic.id,
-                            user_id=current_user.id
-                        )
-                        db.session.add(attachment)
+                db.session.add_all(build_attachments(request.files.getlist('files'), topic_id=new_topic.id))
             
             db.session.commit()
+            cache.delete(LATEST_TOPICS_CACHE_KEY)
             flash('Тема успешно создана!', 'success')
             return redirect(url_for('topic', topic_id=new_topic.id))
         else:
@@ -152,7 +459,13 @@ def new_topic():
 
 @app.route('/topic/<int:topic_id>')
 def topic(topic_id):
-    topic = Topic.query.get_or_404(topic_id)
+    # Авторы и вложения ответов подгружаются пачкой, а не отдельным запросом на каждый ответ
+    topic = Topic.query.options(
+        selectinload(Topic.author),
+        selectinload(Topic.attachments),
+        selectinload(Topic.replies).selectinload(Reply.author),
+        selectinload(Topic.replies).selectinload(Reply.attachments)
+    ).get_or_404(topic_id)
 
     if topic.is_deleted:
         flash('Тема была удалена', 'error')
@@ -162,8 +475,7 @@ def topic(topic_id):
         flash('Автор темы удалил свой аккаунт', 'error')
         return redirect(url_for('topics'))
 
-    topic.views += 1
-    db.session.commit()
+    count_view(topic.id)
     
     return render_template('topic.html', topic=topic)
 
@@ -177,6 +489,7 @@ def delete_own_account():
         if current_user.check_password(password):
             current_user.is_active = False
             db.session.commit()
+            forget_user(current_user.id)
             
             logout_user()
             flash('Ваш аккаунт успешно удален', 'success')
@@ -202,6 +515,7 @@ def admin_delete_user(user_id):
     else:
         user.is_active = False
         db.session.commit()
+        forget_user(user.id)
         flash(f'Аккаунт пользователя {user.username} удален', 'success')
     
     return redirect(url_for('admin_users'))
@@ -216,6 +530,7 @@ def admin_restore_user(user_id):
     user = User.query.get_or_404(user_id)
     user.is_active = True
     db.session.commit()
+    forget_user(user.id)
     flash(f'Аккаунт пользователя {user.username} восстановлен', 'success')
     
     return redirect(url_for('admin_users'))
@@ -227,8 +542,17 @@ def admin_users():
         flash('Недостаточно прав', 'error')
         return redirect(url_for('index'))
     
-    users = User.query.order_by(User.created_at.desc()).all()
-    return render_template('admin_users.html', users=users)
+    # raiseload: шаблон не должен лениво грузить user.topics / user.replies
+    users, next_url = keyset_page(User.query.options(raiseload('*')), User, 50, 'admin_users')
+
+    user_ids = [user.id for user in users]
+    topic_counts = dict(db.session.query(Topic.user_id, func.count(Topic.id))
+                        .filter(Topic.user_id.in_(user_ids)).group_by(Topic.user_id))
+    reply_counts = dict(db.session.query(Reply.user_id, func.count(Reply.id))
+                        .filter(Reply.user_id.in_(user_ids)).group_by(Reply.user_id))
+
+    return render_template('admin_users.html', users=users, next_url=next_url,
+                           topic_counts=topic_counts, reply_counts=reply_counts)
 
 @app.route('/reply/<int:topic_id>', methods=['POST'])
 @login_required
@@ -237,26 +561,16 @@ def reply(topic_id):
     content = request.form.get('content')
     
     if content:
-        new_reply = Reply(content=content, user_id=current_user.id, topic_id=topic_id)
+        now = datetime.utcnow()
+        new_reply = Reply(content=content, user_id=current_user.id, topic_id=topic_id, created_at=now)
         db.session.add(new_reply)
+        topic.reply_count = Topic.reply_count + 1  # инкремент на стороне БД
+        topic.last_reply_at = now
+        topic.last_reply_user_id = current_user.id
         db.session.flush()
         
         if 'files' in request.files:
-            files = request.files.getlist('files')
-            for file in files:
-                if file and file.filename and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    unique_filename = f"{datetime.now().timestamp()}_{filename}"
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(file_path)
-                    
-                    attachment = Attachment(
-                        filename=unique_filename,
-                        original_filename=filename,
-                        reply_id=new_reply.id,
-                        user_id=current_user.id
-                    )
-                    db.session.add(attachment)
+            db.session.add_all(build_attachments(request.files.getlist('files'), reply_id=new_reply.id))
         
         db.session.commit()
         flash('Ответ добавлен!', 'success')
@@ -310,10 +624,13 @@ def register():
         if len(password) < 6:
             errors.append('Пароль должен содержать не менее 6 символов')
         
-        if User.query.filter_by(username=username).first():
+        taken = db.session.query(User.username, User.email)\
+            .filter(or_(User.username == username, User.email == email)).all()
+        
+        if any(row.username == username for row in taken):
             errors.append('Имя пользователя уже занято')
         
-        if User.query.filter_by(email=email).first():
+        if any(row.email == email for row in taken):
             errors.append('Email уже зарегистрирован')
         
         if errors:
@@ -324,7 +641,16 @@ def register():
             new_user.set_password(password)
             
             db.session.add(new_user)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError as e:
+                # Параллельная регистрация успела занять имя или email после проверки выше
+                db.session.rollback()
+                if 'username' in str(e.orig):
+                    flash('Имя пользователя уже занято', 'error')
+                else:
+                    flash('Email уже зарегистрирован', 'error')
+                return render_template('register.html')
             
             flash('Регистрация прошла успешно! Теперь вы можете войти.', 'success')
             return redirect(url_for('login'))
@@ -340,7 +666,8 @@ def logout():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Имена файлов - хеши содержимого, поэтому ответ можно кешировать навсегда
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=31536000, conditional=True)
 
 @app.route('/admin/delete_topic/<int:topic_id>', methods=['POST'])
 @login_required
@@ -352,6 +679,7 @@ def admin_delete_topic(topic_id):
     topic = Topic.query.get_or_404(topic_id)
     topic.is_deleted = True
     db.session.commit()
+    cache.delete(LATEST_TOPICS_CACHE_KEY)
     
     flash('Тема успешно удалена', 'success')
     return redirect(url_for('topics'))
@@ -366,10 +694,16 @@ def admin_restore_topic(topic_id):
     topic = Topic.query.get_or_404(topic_id)
     topic.is_deleted = False
     db.session.commit()
+    cache.delete(LATEST_TOPICS_CACHE_KEY)
     
     flash('Тема восстановлена', 'success')
     return redirect(url_for('topics'))
 
+#рендер через 10 минут сервер глушит если никого нету: внешний пингер (cron/UptimeRobot) дергает /healthz
+@app.route('/healthz')
+def healthz():
+    return 'ok', 200
+
 @app.route('/admin/topics')
 @login_required
 def admin_topics():
@@ -380,53 +714,33 @@ def admin_topics():
     deleted_topics = Topic.query.filter_by(is_deleted=True).all()
     return render_template('admin_topics.html', topics=deleted_topics)
 
-#рендер через 10 минут сервер глушит если никого нету это что бы не глушил
-def start_keep_alive():
-    import threading
+def start_views_flusher():
     import time
-    import requests
-    from datetime import datetime
     
-    def ping_server():
+    def flush_loop():
         while True:
+            time.sleep(VIEWS_FLUSH_INTERVAL)
             try:
-                base_url = os.environ.get('RENDER_EXTERNAL_URL', 'http://localhost:5000')
-                requests.get(f"{base_url}/", timeout=5)
-                print(f"{datetime.now()} - Keep-alive ping sent to {base_url}")
+                with app.app_context():
+                    flush_views()
             except Exception as e:
-                print(f"{datetime.now()} - Ping error: {e}")
-            time.sleep(300)  
+                print(f"{datetime.now()} - Views flush error: {e}")
     
-    thread = threading.Thread(target=ping_server, daemon=True)
+    # Последний сброс при остановке воркера (рестарт, засыпание инстанса на Render)
+    def flush_on_exit():
+        try:
+            with app.app_context():
+                flush_views()
+        except Exception as e:
+            print(f"{datetime.now()} - Views flush error: {e}")
+    
+    thread = threading.Thread(target=flush_loop, daemon=True)
     thread.start()
+    atexit.register(flush_on_exit)
 
-start_keep_alive()
+start_views_flusher()
 
 if __name__ == '__main__':
-
-    with app.app_context():
-        db.drop_all()
-        db.create_all()
-
-        test_admin = User(username='Curaga', email='admin@dash.com', is_admin=True)
-        test_admin.set_password('1234')
-        db.session.add(test_admin)
-
-        topic1 = Topic(title='Добро пожаловать на форум!', 
-                      content='Это тестовая тема для демонстрации работы форума.', 
-                      user_id=1)
-        topic2 = Topic(title='Правила форума', 
-                      content='Здесь будут правила нашего форума.', 
-                      user_id=1)
-        db.session.add_all([topic1, topic2])
-        
-        reply1 = Reply(content='Отличный форум!', user_id=1, topic_id=1)
-        reply2 = Reply(content='Согласен с правилами', user_id=1, topic_id=2)
-        db.session.add_all([reply1, reply2])
-        
-        db.session.commit()
-        print("Test data created successfully!")
-    
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
 